@@ -2,31 +2,84 @@ import logging
 import os
 
 import cv2
+import torch
 from flask import Flask
-from transformers import YolosForObjectDetection, YolosImageProcessor
+from transformers import YolosImageProcessor
 
+from app.services.cascade_classifiers import CascadeParameters, ThreadLocalCascadeClassifiers
+from app.services.detection_models import build_preprocessor, load_detection_model
 from app.services.image_masking import ImageMasker
+from app.services.pdf_masking import PDFMasker
 
-# Multiple cascade classifiers for face detection in different orientations.
+# Multiple cascade classifiers for face detection in different orientations, with their detection parameters.
+# Faces and upper bodies have to be at least an eighth of the area of interest. Eyes and ears are much smaller,
+# but still at least a sixteenth of it, as the areas of interest are the persons found by the detection model.
+# The faces come first, because the ImageMasker waits for the classifiers in this order and stops at the first hit.
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root_dir = os.path.dirname(current_dir)
-xml_files = [
-    os.path.join(project_root_dir, 'data', 'haarcascade_mcs_leftear.xml'),
-    os.path.join(project_root_dir, 'data', 'haarcascade_mcs_rightear.xml'),
-    os.path.join(project_root_dir, 'data', 'haarcascade_frontalface_default.xml'),
-    os.path.join(project_root_dir, 'data', 'haarcascade_profileface.xml'),
-    os.path.join(project_root_dir, 'data', 'haarcascade_eye.xml'),
-    os.path.join(project_root_dir, 'data', 'haarcascade_upperbody.xml'),
-    os.path.join(project_root_dir, 'data', 'haarcascade_mcs_upperbody.xml')
+face_parameters = CascadeParameters(scale_factor=1.2, min_neighbors=4, min_size_ratio=8)
+feature_parameters = CascadeParameters(scale_factor=1.2, min_neighbors=3, min_size_ratio=16)
+cascade_files = [
+    (os.path.join(project_root_dir, 'data', 'haarcascade_frontalface_default.xml'), face_parameters),
+    (os.path.join(project_root_dir, 'data', 'haarcascade_profileface.xml'), face_parameters),
+    (os.path.join(project_root_dir, 'data', 'haarcascade_upperbody.xml'), face_parameters),
+    (os.path.join(project_root_dir, 'data', 'haarcascade_mcs_upperbody.xml'), face_parameters),
+    (os.path.join(project_root_dir, 'data', 'haarcascade_eye.xml'), feature_parameters),
+    (os.path.join(project_root_dir, 'data', 'haarcascade_mcs_leftear.xml'), feature_parameters),
+    (os.path.join(project_root_dir, 'data', 'haarcascade_mcs_rightear.xml'), feature_parameters)
 ]
-cascade_classifiers = [cv2.CascadeClassifier(xml) for xml in xml_files]
+xml_files = [xml_file for xml_file, _ in cascade_files]
+cascade_parameters = [parameters for _, parameters in cascade_files]
+cascade_classifiers = ThreadLocalCascadeClassifiers(xml_files)
 
-# AI model for detecting areas in images.
-detection_model = YolosForObjectDetection.from_pretrained('hustvl/yolos-tiny')
-image_processor = YolosImageProcessor.from_pretrained("hustvl/yolos-tiny")
+# The models and the maskers shared by all requests. They are loaded by init_services instead of on import,
+# so the page worker processes of the PDFMasker can limit their threads before loading them.
+detection_model = None
+image_processor = None
+preprocessor = None
+image_masker = None
+pdf_masker = None
+
+
+def init_services(num_threads: int = None):
+    """
+    Loads the models and creates the maskers shared by all requests. Nothing is done if they are already loaded.
+    :param num_threads: The number of threads the models and classifiers may use. Defaults to the number of cores.
+    """
+    global detection_model, image_processor, preprocessor, image_masker, pdf_masker
+    if pdf_masker is not None:
+        return
+    num_threads = num_threads or os.cpu_count() or 1
+
+    # The ImageMasker runs the classifiers in parallel. OpenCV's own threading would only oversubscribe the cores.
+    cv2.setNumThreads(1)
+
+    # The detection model gets half of the threads, which leaves the other half to the cascade classifiers of
+    # concurrent requests. This has to be set before torch runs anything in parallel.
+    torch.set_num_threads(max(1, num_threads // 2))
+    torch.set_num_interop_threads(1)
+
+    # AI model for detecting areas in images. Exported to ONNX (or a TensorRT engine on CUDA GPUs) on first start
+    # and cached next to the classifiers.
+    detection_model = load_detection_model('hustvl/yolos-tiny', os.path.join(project_root_dir, 'data'))
+    image_processor = YolosImageProcessor.from_pretrained("hustvl/yolos-tiny")
+    # Replacement for the resize and normalization of the image processor, running in native torch kernels.
+    preprocessor = build_preprocessor(image_processor)
+
+    # The maskers don't hold any state between requests and are shared by all of them.
+    image_masker = ImageMasker(
+        cascade_classifiers,
+        detection_model,
+        image_processor,
+        preprocessor=preprocessor,
+        cascade_parameters=cascade_parameters,
+        num_threads=num_threads
+    )
+    pdf_masker = PDFMasker(image_masker)
 
 
 def create_app():
+    init_services()
     app = Flask(__name__)
 
     from app.routes.main import main_blueprint
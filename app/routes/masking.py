@@ -2,9 +2,7 @@ import io
 
 from flask import Blueprint, jsonify, request, send_file
 
-from app import cascade_classifiers, detection_model, image_processor
-from app.services.image_masking import ImageMasker
-from app.services.pdf_masking import PDFMasker
+from app import image_masker, pdf_masker
 
 masking_blueprint = Blueprint('api', __name__, url_prefix='/api/v1/mask')
 
@@ -36,8 +34,7 @@ def mask_pdf():
 
     gizmos = request.args.get('gizmos', default=False, type=bool)
 
-    masker = PDFMasker(ImageMasker(cascade_classifiers, detection_model, image_processor))
-    result = masker.mask_file(file, should_draw_gizmos=gizmos)
+    result = pdf_masker.mask_file(file, should_draw_gizmos=gizmos)
 
     return send_file(
         io.BytesIO(result),
@@ -72,8 +69,7 @@ def mask_image():
     gizmos = request.args.get('gizmos', default=False, type=bool)
 
     try:
-        masker = ImageMasker(cascade_classifiers, detection_model, image_processor)
-        result, _ = masker.mask_file(file, should_draw_gizmos=gizmos)
+        result, _ = image_masker.mask_file(file, should_draw_gizmos=gizmos)
     except Exception as e:
         return jsonify({"success": False, "message": str(e), "code": 500}), 500
 
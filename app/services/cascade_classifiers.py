@@ -0,0 +1,48 @@
+import threading
+from collections.abc import Sequence
+from typing import List, NamedTuple, Optional
+
+import cv2
+
+
+class CascadeParameters(NamedTuple):
+    """
+    Parameters for detectMultiScale of a single cascade classifier. The defaults are the ones of OpenCV.
+    If a minimum size ratio is given, detected objects have to be at least that fraction of the searched image.
+    """
+    scale_factor: float = 1.1
+    min_neighbors: int = 3
+    min_size_ratio: Optional[int] = None
+
+
+class ThreadLocalCascadeClassifiers(Sequence):
+    """
+    A list of cascade classifiers with separate instances for every thread.
+    OpenCV cascade classifiers are not safe to use from multiple threads at the same time.
+    """
+
+    def __init__(self, xml_files: List[str]):
+        """
+        Initializes the ThreadLocalCascadeClassifiers with the files to load the classifiers from.
+        The classifiers are loaded lazily the first time a thread accesses them.
+        :param xml_files: The paths to the cascade classifier files.
+        """
+        self.xml_files = xml_files
+        self.local = threading.local()
+
+    def classifiers(self) -> List[cv2.CascadeClassifier]:
+        """
+        Returns the cascade classifiers of the current thread and loads them if necessary.
+        :return: The cascade classifiers of the current thread.
+        """
+        classifiers = getattr(self.local, 'classifiers', None)
+        if classifiers is None:
+            classifiers = [cv2.CascadeClassifier(xml) for xml in self.xml_files]
+            self.local.classifiers = classifiers
+        return classifiers
+
+    def __getitem__(self, index):
+        return self.classifiers()[index]
+
+    def __len__(self) -> int:
+        return len(self.xml_files)
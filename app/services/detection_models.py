@@ -0,0 +1,299 @@
+import os
+import tempfile
+import threading
+from collections import namedtuple
+from typing import List
+
+import torch
+from torchvision.transforms import v2
+from transformers import YolosForObjectDetection, YolosImageProcessor
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+try:
+    import tensorrt
+except ImportError:
+    tensorrt = None
+
+# Output of the wrapped detection models. Holds the fields the image processor needs for post-processing.
+DetectionOutput = namedtuple('DetectionOutput', ['logits', 'pred_boxes'])
+
+
+class TorchDetectionModel:
+    """
+    A detection model running the HuggingFace model with PyTorch, usually in reduced precision.
+    It can be called like the HuggingFace model and returns the logits and predicted boxes in full precision.
+    """
+
+    def __init__(self, detection_model: YolosForObjectDetection, device: str, dtype: torch.dtype):
+        """
+        Initializes the TorchDetectionModel by moving the model weights to the device and precision.
+        :param detection_model: The HuggingFace detection model.
+        :param device: The device to run the model on.
+        :param dtype: The precision to run the model in.
+        """
+        self.detection_model = detection_model.to(device=device, dtype=dtype).eval()
+        self.device = device
+        self.dtype = dtype
+
+    def __call__(self, pixel_values: torch.Tensor, **kwargs) -> DetectionOutput:
+        """
+        Runs the detection model on the pixel values.
+        :param pixel_values: The preprocessed images as a tensor of shape [N, 3, H, W].
+        :return: The logits and predicted boxes of the detection model.
+        """
+        # Inference mode skips the autograd bookkeeping. Autocast keeps precision sensitive operations like the
+        # layer norms in full precision and is not needed if the model already runs in full precision.
+        autocast = torch.autocast(device_type=self.device, dtype=self.dtype, enabled=self.dtype != torch.float32)
+        with torch.inference_mode(), autocast:
+            outputs = self.detection_model(pixel_values=pixel_values.to(device=self.device, dtype=self.dtype))
+        return DetectionOutput(outputs.logits.float().cpu(), outputs.pred_boxes.float().cpu())
+
+
+class OnnxDetectionModel:
+    """
+    A detection model running an exported ONNX graph with ONNX Runtime.
+    It can be called like the HuggingFace model and returns the logits and predicted boxes.
+    """
+
+    def __init__(self, onnx_path: str, providers: List[str] = None, num_threads: int = 0):
+        """
+        Initializes the OnnxDetectionModel with an inference session for the ONNX graph.
+        Providers that are not available in the installed ONNX Runtime are skipped.
+        :param onnx_path: The path to the exported ONNX model.
+        :param providers: The execution providers to use, in order of preference.
+        :param num_threads: The number of threads for a single inference. 0 uses all cores.
+        """
+        if providers is None:
+            providers = ['OpenVINOExecutionProvider', 'CPUExecutionProvider']
+        available_providers = onnxruntime.get_available_providers()
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        session_options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            onnx_path,
+            sess_options=session_options,
+            providers=[provider for provider in providers if provider in available_providers]
+        )
+
+    def __call__(self, pixel_values: torch.Tensor, **kwargs) -> DetectionOutput:
+        """
+        Runs the detection model on the pixel values.
+        :param pixel_values: The preprocessed images as a tensor of shape [N, 3, H, W].
+        :return: The logits and predicted boxes of the detection model.
+        """
+        logits, pred_boxes = self.session.run(
+            ['logits', 'pred_boxes'],
+            {'pixel_values': pixel_values.numpy()}
+        )
+        return DetectionOutput(torch.from_numpy(logits), torch.from_numpy(pred_boxes))
+
+
+class TensorRTDetectionModel:
+    """
+    A detection model running a serialized TensorRT engine on the GPU.
+    It can be called like the HuggingFace model and returns the logits and predicted boxes.
+    """
+
+    def __init__(self, engine_path: str):
+        """
+        Initializes the TensorRTDetectionModel by deserializing the engine and creating an execution context.
+        Device buffers and the stream are managed by torch, so the engine shares the CUDA context with torch.
+        :param engine_path: The path to the serialized TensorRT engine.
+        """
+        with open(engine_path, 'rb') as engine_file:
+            runtime = tensorrt.Runtime(tensorrt.Logger(tensorrt.Logger.WARNING))
+            self.engine = runtime.deserialize_cuda_engine(engine_file.read())
+        self.context = self.engine.create_execution_context()
+        self.stream = torch.cuda.Stream()
+        # The execution context holds the input shapes and buffer addresses and can only run one request at a time.
+        self.lock = threading.Lock()
+        self.tensor_names = [self.engine.get_tensor_name(i) for i in range(self.engine.num_io_tensors)]
+
+    def __call__(self, pixel_values: torch.Tensor, **kwargs) -> DetectionOutput:
+        """
+        Runs the detection model on the pixel values.
+        :param pixel_values: The preprocessed images as a tensor of shape [N, 3, H, W].
+        :return: The logits and predicted boxes of the detection model.
+        """
+        with self.lock, torch.cuda.stream(self.stream):
+            tensors = {'pixel_values': pixel_values.to(device='cuda', dtype=torch.float16).contiguous()}
+            self.context.set_input_shape('pixel_values', tuple(tensors['pixel_values'].shape))
+            for name in self.tensor_names:
+                if self.engine.get_tensor_mode(name) == tensorrt.TensorIOMode.OUTPUT:
+                    is_half = self.engine.get_tensor_dtype(name) == tensorrt.float16
+                    tensors[name] = torch.empty(
+                        tuple(self.context.get_tensor_shape(name)),
+                        dtype=torch.float16 if is_half else torch.float32,
+                        device='cuda'
+                    )
+                self.context.set_tensor_address(name, tensors[name].data_ptr())
+            self.context.execute_async_v3(self.stream.cuda_stream)
+            logits = tensors['logits'].float().cpu()
+            pred_boxes = tensors['pred_boxes'].float().cpu()
+        return DetectionOutput(logits, pred_boxes)
+
+
+def export_onnx_model(detection_model: YolosForObjectDetection, onnx_path: str) -> None:
+    """
+    Exports the detection model to ONNX with dynamic batch size and image dimensions.
+    :param detection_model: The HuggingFace detection model to export.
+    :param onnx_path: The path to write the ONNX model to.
+    """
+    detection_model.config.return_dict = False
+    detection_model.eval()
+    dummy_pixel_values = torch.randn(1, 3, 512, 512)
+    with torch.no_grad():
+        torch.onnx.export(
+            detection_model,
+            (dummy_pixel_values,),
+            onnx_path,
+            input_names=['pixel_values'],
+            output_names=['logits', 'pred_boxes'],
+            opset_version=17,
+            dynamic_axes={
+                'pixel_values': {0: 'batch', 2: 'height', 3: 'width'},
+                'logits': {0: 'batch'},
+                'pred_boxes': {0: 'batch'}
+            }
+        )
+
+
+def build_tensorrt_engine(onnx_path: str, engine_path: str, max_batch_size: int = 8) -> None:
+    """
+    Builds a TensorRT engine with FP16 precision from the exported ONNX model.
+    The optimization profile covers the image sizes produced by the YOLOS image processor.
+    :param onnx_path: The path to the exported ONNX model.
+    :param engine_path: The path to write the serialized engine to.
+    :param max_batch_size: The largest batch size the engine has to support.
+    """
+    logger = tensorrt.Logger(tensorrt.Logger.WARNING)
+    builder = tensorrt.Builder(logger)
+    network = builder.create_network(1 << int(tensorrt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = tensorrt.OnnxParser(network, logger)
+    with open(onnx_path, 'rb') as onnx_file:
+        if not parser.parse(onnx_file.read()):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise RuntimeError('Could not parse ONNX model: ' + '; '.join(errors))
+    network.get_input(0).dtype = tensorrt.float16
+
+    config = builder.create_builder_config()
+    config.set_flag(tensorrt.BuilderFlag.FP16)
+    profile = builder.create_optimization_profile()
+    profile.set_shape('pixel_values', (1, 3, 32, 32), (1, 3, 512, 800), (max_batch_size, 3, 1333, 1333))
+    config.add_optimization_profile(profile)
+
+    serialized_engine = builder.build_serialized_network(network, config)
+    if serialized_engine is None:
+        raise RuntimeError('Could not build TensorRT engine from ' + onnx_path)
+    with open(engine_path, 'wb') as engine_file:
+        engine_file.write(serialized_engine)
+
+
+def build_preprocessor(image_processor: YolosImageProcessor) -> torch.nn.Module:
+    """
+    Builds a torchvision preprocessing pipeline with the resize and normalization of the image processor.
+    It takes uint8 RGB tensors of shape [N, 3, H, W] and returns the pixel values for the detection model.
+    :param image_processor: The HuggingFace image processor to take the settings from.
+    :return: The preprocessing pipeline.
+    """
+    return torch.nn.Sequential(
+        v2.Resize(
+            image_processor.size['shortest_edge'],
+            max_size=image_processor.size['longest_edge'],
+            antialias=True
+        ),
+        v2.ToDtype(torch.float32, scale=True),
+        v2.Normalize(image_processor.image_mean, image_processor.image_std)
+    )
+
+
+def is_bfloat16_supported() -> bool:
+    """
+    Checks if the CPU runs bfloat16 matrix multiplications natively with AVX512-BF16 or AMX.
+    On other CPUs bfloat16 is emulated and slower than full precision.
+    :return: True if the CPU supports bfloat16 natively, False otherwise.
+    """
+    if not torch.backends.mkldnn.is_available():
+        return False
+    try:
+        if not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            return False
+        with open('/proc/cpuinfo') as cpuinfo:
+            flags = set(cpuinfo.read().split())
+    except (AttributeError, RuntimeError, OSError):
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def load_pretrained_model(model_name: str, dtype: torch.dtype = torch.float32) -> YolosForObjectDetection:
+    """
+    Loads the pretrained HuggingFace detection model directly in the given precision.
+    The weights are loaded without an additional randomly initialized copy of the model to keep the memory low.
+    :param model_name: The name of the pretrained HuggingFace model.
+    :param dtype: The precision to load the weights in.
+    :return: The HuggingFace detection model.
+    """
+    return YolosForObjectDetection.from_pretrained(model_name, torch_dtype=dtype, low_cpu_mem_usage=True)
+
+
+def cache_file(path: str, create) -> str:
+    """
+    Creates the file at the given path if it does not exist yet.
+    The file is written to a unique temporary file first and then moved into place. This way neither an interrupted
+    run nor multiple processes creating the file at the same time can leave a broken cache behind.
+    :param path: The path of the cached file.
+    :param create: A function writing the file to the path it is given.
+    :return: The path of the cached file.
+    """
+    if not os.path.exists(path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.')
+        os.close(file_descriptor)
+        try:
+            create(temporary_path)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+    return path
+
+
+def load_detection_model(model_name: str, cache_dir: str):
+    """
+    Loads the detection model with the fastest backend available.
+    On a CUDA GPU with TensorRT installed, an FP16 engine is built once and cached on disk.
+    If ONNX Runtime is installed, the model is exported to ONNX once and cached on disk.
+    Otherwise, the HuggingFace model is run with PyTorch in half precision on GPUs, in bfloat16 on CPUs with
+    native bfloat16 support and in full precision on all other CPUs.
+    :param model_name: The name of the pretrained HuggingFace model.
+    :param cache_dir: The directory to cache exported models in.
+    :return: A callable detection model.
+    """
+    use_tensorrt = tensorrt is not None and torch.cuda.is_available()
+    if onnxruntime is None and not use_tensorrt:
+        if torch.cuda.is_available():
+            return TorchDetectionModel(load_pretrained_model(model_name, torch.float16), 'cuda', torch.float16)
+        if is_bfloat16_supported():
+            return TorchDetectionModel(load_pretrained_model(model_name, torch.bfloat16), 'cpu', torch.bfloat16)
+        return TorchDetectionModel(load_pretrained_model(model_name), 'cpu', torch.float32)
+
+    base_path = os.path.join(cache_dir, model_name.replace('/', '_'))
+    onnx_path = cache_file(
+        base_path + '.onnx',
+        lambda path: export_onnx_model(load_pretrained_model(model_name), path)
+    )
+    if use_tensorrt:
+        # Engines are specific to the GPU they were built on.
+        device_name = torch.cuda.get_device_name().replace(' ', '_')
+        engine_path = cache_file(
+            base_path + '_' + device_name + '.engine',
+            lambda path: build_tensorrt_engine(onnx_path, path)
+        )
+        return TensorRTDetectionModel(engine_path)
+    # ONNX Runtime uses as many threads as torch was configured to use.
+    return OnnxDetectionModel(onnx_path, num_threads=torch.get_num_threads())
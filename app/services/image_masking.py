@@ -1,31 +1,51 @@
 import mimetypes
-from io import BytesIO
-from typing import List, Tuple
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
 
 import cv2
 import numpy as np
 import torch
-from PIL import Image
 from cv2.typing import MatLike, Rect, Scalar
 from werkzeug.datastructures.file_storage import FileStorage
 
+from app.services.cascade_classifiers import CascadeParameters
+
 
 class ImageMasker:
     """
     A class for masking images by detecting areas containing faces and replacing them with black rectangles.
     """
 
-    def __init__(self, cascade_classifiers: list[cv2.CascadeClassifier], detection_model, image_processor):
+    def __init__(self, cascade_classifiers: Sequence[cv2.CascadeClassifier], detection_model, image_processor,
+                 preprocessor: torch.nn.Module = None,
+                 cascade_parameters: Sequence[CascadeParameters] = None,
+                 num_threads: int = None):
         """
         Initializes the ImageMasker with cascade classifiers, a detection model and an image processor.
+        The optional preprocessor replaces the preprocessing of the image processor.
+        The optional cascade parameters hold the detection parameters for each of the cascade classifiers.
+        The classifiers are used from multiple threads and should be ThreadLocalCascadeClassifiers.
+        The optional number of threads limits the threads running the classifiers and defaults to the number of cores.
         """
         self.cascade_classifiers = cascade_classifiers
+        self.cascade_parameters = cascade_parameters or [CascadeParameters()] * len(cascade_classifiers)
         self.detection_model = detection_model
         self.image_processor = image_processor
+        self.preprocessor = preprocessor
+        # The areas and the classifiers for each area run concurrently, as OpenCV releases the GIL while detecting.
+        # Separate pools are used, so the areas waiting for their classifiers can't block them from running.
+        self.area_pool = ThreadPoolExecutor(max_workers=num_threads or os.cpu_count())
+        self.cascade_pool = ThreadPoolExecutor(max_workers=num_threads or os.cpu_count())
 
         self.min_aspect = 0.5
         self.max_aspect = 2.0
         self.processing_threshold = 0.2
+        self.batch_size = 8
+        self.cascade_min_size = 24
+        # Running the cascade classifiers on OpenCL devices is opt-in. OpenCV's OpenCL path can detect differently
+        # than the CPU path, and it is only used if OpenCV reports a usable device.
+        self.use_opencl = False
 
     def mask_file(self, file: FileStorage,
                   allow_full_mask: bool = False,
@@ -44,7 +64,9 @@ class ImageMasker:
     def mask_data(self, image_as_bytes: bytes,
                   extension: str = '.png',
                   allow_full_mask: bool = False,
-                  should_draw_gizmos: bool = False) -> Tuple[bytes, int]:
+                  should_draw_gizmos: bool = False,
+                  areas_of_interest: Optional[List[Rect]] = None,
+                  image: Optional[MatLike] = None) -> Tuple[bytes, int]:
         """
         Masks the image data by detecting areas with faces and replacing them with black rectangles.
         The image data is read from bytes, and the resulting masked image is returned as bytes.
@@ -52,12 +74,19 @@ class ImageMasker:
         :param extension: The extension of the image file.
         :param allow_full_mask: Whether to allow full masking of the image.
         :param should_draw_gizmos: Whether to draw gizmos around the detected areas.
+        :param areas_of_interest: Already found areas of interest. They are searched in the image if not given.
+        :param image: The already decoded image data. It is decoded from the bytes if not given.
         :return: The masked image as bytes.
         """
-        mat = cv2.imdecode(np.frombuffer(image_as_bytes, np.uint8), cv2.IMREAD_COLOR)
-        image = Image.open(BytesIO(image_as_bytes))
-        areas_of_interest = self.find_rects_of_interest(image, allow_full_mask)
-        areas, detected_faces = self.detect_maskable_areas(mat, areas_of_interest)
+        mat = image if image is not None else self.decode(image_as_bytes)
+        # The cascade classifiers work on grayscale images. Converting once saves a conversion per classifier call.
+        gray = cv2.cvtColor(mat, cv2.COLOR_BGR2GRAY)
+        if areas_of_interest is None:
+            areas_of_interest = self.find_rects_of_interest(cv2.cvtColor(mat, cv2.COLOR_BGR2RGB), allow_full_mask)
+        areas, detected_faces = self.detect_maskable_areas(gray, areas_of_interest)
+        if not should_draw_gizmos and len(areas) == 0:
+            # Nothing has to be masked, so the original image data is returned without encoding it again.
+            return image_as_bytes, 0
         if should_draw_gizmos:
             self.draw_gizmos(areas_of_interest, mat, color=(0, 0, 0))
             self.draw_gizmos(areas, mat, color=(255, 0, 0))
@@ -67,6 +96,14 @@ class ImageMasker:
         _, encoded_result = cv2.imencode(extension, mat)
         return encoded_result.tobytes(), len(areas)
 
+    def decode(self, image_as_bytes: bytes) -> MatLike:
+        """
+        Decodes the image data into a BGR image.
+        :param image_as_bytes: The image data to decode.
+        :return: The decoded image.
+        """
+        return cv2.imdecode(np.frombuffer(image_as_bytes, np.uint8), cv2.IMREAD_COLOR)
+
     def mask_areas(self, areas, image: MatLike) -> None:
         """
         Masks all the specified areas in the image by replacing them with black rectangles.
@@ -82,7 +119,9 @@ class ImageMasker:
         :param area: The area to mask.
         :param image: The image to mask.
         """
-        cv2.rectangle(image, area[0:2], (area[0] + area[2], area[1] + area[3]), (0, 0, 0), -1)
+        # Writing into the slice avoids the overhead of cv2.rectangle. Like the filled rectangle, the slice includes
+        # the bottom right corner and is clipped at the image borders.
+        image[max(0, area[1]):area[1] + area[3] + 1, max(0, area[0]):area[0] + area[2] + 1] = 0
 
     def draw_gizmos(self, areas, image: MatLike, color: Scalar = (255, 255, 0)) -> None:
         """
@@ -99,50 +138,85 @@ class ImageMasker:
         Detects maskable areas in the image using the cascade classifiers.
         They are checked against the areas of interest and only kept if a face is detected.
         Returns a list of rectangles representing the detected areas.
-        :param image: The image to detect maskable areas in.
+        :param image: The grayscale image to detect maskable areas in.
         :param areas_of_interest: The areas of interest to check against.
         :return: A list of rectangles representing the detected areas.
         """
+        # Every area is copied into a compact buffer once, which is then shared by all classifiers of that area.
+        partial_images = [
+            np.ascontiguousarray(image[rect[1]:rect[1] + rect[3], rect[0]:rect[0] + rect[2]])
+            for rect in areas_of_interest
+        ]
         areas = []
         detected_gizmos = []
-        for rect in areas_of_interest:
-            partial_image = image[rect[1]:rect[1] + rect[3], rect[0]:rect[0] + rect[2]]
-            detected = self.detect_faces(partial_image)
+        for rect, detected in zip(areas_of_interest, self.area_pool.map(self.detect_faces, partial_images)):
             if len(detected) > 0:
                 areas.append(rect)
-                detected = [(d[0] + rect[0], d[1] + rect[1], d[2], d[3]) for d in detected]
-                detected_gizmos.extend(detected)
-        return areas, detected_gizmos
+                # Move the detections from the coordinates of the area to the coordinates of the image.
+                detected_gizmos.append(detected + np.array([rect[0], rect[1], 0, 0], dtype=detected.dtype))
+        if len(detected_gizmos) == 0:
+            return areas, []
+        return areas, list(map(tuple, np.concatenate(detected_gizmos).tolist()))
 
-    def find_rects_of_interest(self, image: Image, allow_full_mask: bool = False) -> List[Rect]:
+    def find_rects_of_interest(self, image: MatLike, allow_full_mask: bool = False) -> List[Rect]:
         """
         Finds rectangles of interest in the image using the AI detection model.
         Returns a list of rectangles representing the areas of interest.
-        :param image: The image to find rectangles of interest in.
+        :param image: The RGB image to find rectangles of interest in.
         :param allow_full_mask: Whether to allow full masking of the image.
         :return: A list of rectangles representing the areas of interest.
         """
-        rects = []
         if allow_full_mask:
-            rects.append((0, 0, image.size[0], image.size[1]))
-            return rects
-
-        image = image.convert("RGB")
-        inputs = self.image_processor(images=image, return_tensors="pt")
-        outputs = self.detection_model(**inputs)
-        target_sizes = torch.tensor([image.size[::-1]])
-        results = self.image_processor.post_process_object_detection(
-            outputs,
-            threshold=self.processing_threshold,
-            target_sizes=target_sizes
-        )[0]
-
-        for score, label, box in zip(results["scores"], results["labels"], results["boxes"]):
-            box = [int(round(i, 0)) for i in box.tolist()]
-            rect = (box[0], box[1], box[2] - box[0], box[3] - box[1])
-            if allow_full_mask or not self.is_overlapping_full_image(rect, image):
-                rects.append(rect)
-        return rects
+            return [(0, 0, image.shape[1], image.shape[0])]
+        return self.find_rects_of_interest_batch([image])[0]
+
+    def find_rects_of_interest_batch(self, images: List[MatLike]) -> List[List[Rect]]:
+        """
+        Finds rectangles of interest in multiple images with batched runs of the AI detection model.
+        The preprocessed images are padded to the same size, so up to batch_size images share one forward pass.
+        Returns a list of rectangles representing the areas of interest for each image.
+        :param images: The RGB images to find rectangles of interest in.
+        :return: A list of rectangles representing the areas of interest for each image.
+        """
+        rects_per_image = []
+        for start in range(0, len(images), self.batch_size):
+            batch_images = images[start:start + self.batch_size]
+            pixel_values = [self.preprocess(image) for image in batch_images]
+            max_height = max(values.shape[1] for values in pixel_values)
+            max_width = max(values.shape[2] for values in pixel_values)
+            batch = torch.zeros((len(pixel_values), 3, max_height, max_width))
+            for i, values in enumerate(pixel_values):
+                batch[i, :, :values.shape[1], :values.shape[2]] = values
+
+            outputs = self.detection_model(pixel_values=batch)
+            # Like in DETR, the boxes are normalized to each image before padding, so they are scaled by its own size.
+            target_sizes = torch.tensor([image.shape[:2] for image in batch_images])
+            results = self.image_processor.post_process_object_detection(
+                outputs,
+                threshold=self.processing_threshold,
+                target_sizes=target_sizes
+            )
+
+            for image, result in zip(batch_images, results):
+                boxes = result["boxes"].round().to(torch.int32).cpu().numpy()
+                rects = np.concatenate([boxes[:, 0:2], boxes[:, 2:4] - boxes[:, 0:2]], axis=1)
+                rects = rects[~self.is_overlapping_full_image(rects, image)]
+                rects_per_image.append(list(map(tuple, rects.tolist())))
+        return rects_per_image
+
+    def preprocess(self, image: MatLike) -> torch.Tensor:
+        """
+        Resizes and normalizes the image for the AI detection model.
+        :param image: The RGB image to preprocess.
+        :return: The pixel values of the image as a tensor of shape [3, H, W].
+        """
+        if self.preprocessor is None:
+            return self.image_processor(
+                images=image,
+                return_tensors="pt",
+                input_data_format="channels_last"
+            )["pixel_values"][0]
+        return self.preprocessor(torch.from_numpy(image).permute(2, 0, 1).unsqueeze(0))[0]
 
     def is_within_aspect_ratio(self, rect: Rect) -> bool:
         """
@@ -154,28 +228,62 @@ class ImageMasker:
         aspect_ratio = rect[2] / rect[3]
         return self.min_aspect <= aspect_ratio <= self.max_aspect
 
-    def is_overlapping_full_image(self, rect: Rect, image: Image) -> bool:
+    def is_overlapping_full_image(self, rect: Rect, image: MatLike) -> bool:
         """
         Checks if the rectangle overlaps more than 70% of the image.
+        An array of rectangles can be passed as well, which returns an array with the result for each rectangle.
         :param rect: The rectangle to check for overlap.
         :param image: The image to check for overlap with.
         :return: True if the rectangle overlaps more than 70% of the image, False otherwise.
         """
-        bbox = image.size
-        return ((rect[2] / bbox[0]) > 0.7) or ((rect[3] / bbox[1]) > 0.7)
+        rect = np.asarray(rect)
+        height, width = image.shape[:2]
+        return ((rect[..., 2] / width) > 0.7) | ((rect[..., 3] / height) > 0.7)
 
-    def detect_faces(self, image: MatLike) -> List[Rect]:
+    def detect_faces(self, image: MatLike) -> np.ndarray:
         """
         Detects faces in the image using the cascade classifiers.
-        Returns True if at least one face is detected, False otherwise.
+        Returns the detections of the first classifier that detects anything.
         :param image: The image to detect faces in.
-        :return: A tuple containing a list of tuples for each detected face.
+        :return: An array with a row of (x, y, w, h) for each detected face.
         """
-        rects = []
-        for classifier in self.cascade_classifiers:
-            faces_detected = classifier.detectMultiScale(image)
+        futures = [
+            self.cascade_pool.submit(self.detect_with_classifier, index, image)
+            for index in range(len(self.cascade_classifiers))
+        ]
+        # The results are checked in the order of the classifiers, so the first classifier with a detection wins.
+        for index, future in enumerate(futures):
+            faces_detected = future.result()
             if len(faces_detected) > 0:
-                for (x, y, w, h) in faces_detected:
-                    rects.append((x, y, w, h))
-                return rects
-        return rects
+                for remaining_future in futures[index + 1:]:
+                    remaining_future.cancel()
+                return faces_detected
+        return np.empty((0, 4), dtype=np.int32)
+
+    def detect_with_classifier(self, index: int, image: MatLike) -> MatLike:
+        """
+        Detects objects in the image with a single cascade classifier and its parameters.
+        The classifier is looked up in the running thread, so thread local classifiers are never shared.
+        :param index: The index of the cascade classifier to use.
+        :param image: The image to detect objects in.
+        :return: The rectangles of the detected objects.
+        """
+        parameters = self.cascade_parameters[index]
+        image_size = image.shape[1::-1]
+        if self.use_opencl and cv2.ocl.haveOpenCL() and cv2.ocl.useOpenCL():
+            # Every classifier uploads its own copy, so no UMat is shared between the threads of the cascade pool.
+            image = cv2.UMat(image)
+        min_size = (0, 0)
+        if parameters.min_size_ratio is not None:
+            # A minimum size relative to the area skips most of the tiny detection windows.
+            min_size = (
+                max(self.cascade_min_size, image_size[0] // parameters.min_size_ratio),
+                max(self.cascade_min_size, image_size[1] // parameters.min_size_ratio)
+            )
+        return self.cascade_classifiers[index].detectMultiScale(
+            image,
+            scaleFactor=parameters.scale_factor,
+            minNeighbors=parameters.min_neighbors,
+            minSize=min_size,
+            flags=cv2.CASCADE_SCALE_IMAGE
+        )
@@ -1,10 +1,19 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
+from typing import List, Optional, Tuple
 
+import cv2
 import fitz  # PyMuPDF
-from PIL import Image
+import numpy as np
+from cv2.typing import MatLike
 from werkzeug.datastructures.file_storage import FileStorage
 
-from app import ImageMasker
+from app.services.image_masking import ImageMasker
 
 
 class PDFMasker:
@@ -17,6 +26,15 @@ class PDFMasker:
         Initializes the PDFMasker with an ImageMasker instance.
         """
         self.image_masker = image_masker
+        # Every worker loads its own models, so only a few workers are started. The cores are split between them,
+        # so that all workers together don't use more threads than there are cores.
+        self.max_page_workers = 4
+        self.page_workers = max(1, min(self.max_page_workers, (os.cpu_count() or 1) // 2))
+        self.page_worker_threads = max(1, (os.cpu_count() or 1) // self.page_workers)
+        self.min_image_size = 64
+        self.max_image_aspect = 5.0
+        self.page_pool = None
+        self.page_pool_lock = threading.Lock()
 
     def mask_file(self, file: FileStorage, should_draw_gizmos: bool = False) -> bytes:
         """
@@ -29,45 +47,196 @@ class PDFMasker:
     def mask_data(self, pdf_as_bytes: bytes, should_draw_gizmos: bool = False) -> bytes:
         """
         Masks the PDF data by detecting areas with faces and replacing them with black rectangles.
+        If multiple pages have images that may contain a face, they are masked in parallel by a pool of worker
+        processes. A single page is masked in this process, where the models can use more threads.
         :param pdf_as_bytes: The PDF data to mask.
         :param should_draw_gizmos: Whether to draw gizmos around the detected areas.
         :return: The masked PDF data.
         """
         pdf_document = fitz.open(stream=pdf_as_bytes, filetype="pdf")
-        for page_number in range(len(pdf_document)):
+        # Pages without any images that may contain a face don't have to be masked at all.
+        page_numbers = [
+            page_number for page_number in range(len(pdf_document))
+            if self.may_contain_faces(pdf_document.load_page(page_number))
+        ]
+        replacements = None
+        if len(page_numbers) > 1 and self.page_workers > 1:
+            replacements = self.mask_pages_in_pool(pdf_as_bytes, page_numbers, should_draw_gizmos)
+        if replacements is None:
+            replacements = [
+                self.mask_page(pdf_document, page_number, should_draw_gizmos) for page_number in page_numbers
+            ]
+
+        if not any(replacements):
+            # Nothing was masked, so the original PDF can be returned without serializing it again.
+            pdf_document.close()
+            return pdf_as_bytes
+
+        for page_number, page_replacements in zip(page_numbers, replacements):
             page = pdf_document.load_page(page_number)
-            page_width = page.mediabox.width
-            page_height = page.mediabox.height
-            image_list = page.get_images(full=True)
-
-            for img_index, img_info in enumerate(image_list):
-                xref = img_info[0]
-                image_obj = pdf_document.extract_image(xref)
-                # Check if the image has a soft mask. This is usually the case for images with transparency
-                # like PNGs and GIFs. The soft mask can also occur in images that have ocr text on top of the
-                # image. Those images should be ignored.
-                # todo: This is a workaround for behavior in different PDF creation tools and has to be monitored.
-                if image_obj["smask"] != 0 and not (image_obj["ext"] == 'png' or image_obj["ext"] == 'gif'):
-                    continue
-
-                image_bytes = image_obj["image"]
-                image = Image.open(BytesIO(image_bytes))
-                overlapping = self.is_overlapping_full_page(image, page_width, page_height)
-                result, amount_of_masks = self.image_masker.mask_data(
-                    image_bytes,
-                    allow_full_mask=not overlapping,
-                    should_draw_gizmos=should_draw_gizmos
-                )
-                if amount_of_masks > 0:
-                    # Only replace the image if any faces were detected. This keeps the original
-                    # PDF content intact as much as possible.
-                    page.replace_image(xref, pixmap=fitz.Pixmap(BytesIO(result)))
+            for xref, result in page_replacements:
+                page.replace_image(xref, pixmap=fitz.Pixmap(BytesIO(result)))
 
         modified_pdf_as_bytes = pdf_document.tobytes()
         pdf_document.close()
         return modified_pdf_as_bytes
 
-    def is_overlapping_full_page(self, image: Image, width: int, height: int) -> bool:
+    def mask_page(self, pdf_document: fitz.Document, page_number: int,
+                  should_draw_gizmos: bool = False) -> List[Tuple[int, bytes]]:
+        """
+        Masks the images of a single page by detecting areas with faces.
+        The page itself is not changed. Instead, the masked images are returned to be replaced by the caller.
+        :param pdf_document: The PDF document containing the page.
+        :param page_number: The number of the page to mask.
+        :param should_draw_gizmos: Whether to draw gizmos around the detected areas.
+        :return: A list of tuples with the xref and the masked data of every image that has to be replaced.
+        """
+        page = pdf_document.load_page(page_number)
+        page_width = page.mediabox.width
+        page_height = page.mediabox.height
+        image_list = page.get_images(full=True)
+
+        # Collect all images first, so the detection model can run on them in batches.
+        pending_images = []
+        for img_index, img_info in enumerate(image_list):
+            xref = img_info[0]
+            if not self.may_contain_face(img_info[2], img_info[3]):
+                # Icons, logos and decorative strips are skipped without extracting or decoding them.
+                continue
+            image_obj = pdf_document.extract_image(xref)
+            # Check if the image has a soft mask. This is usually the case for images with transparency
+            # like PNGs and GIFs. The soft mask can also occur in images that have ocr text on top of the
+            # image. Those images should be ignored.
+            # todo: This is a workaround for behavior in different PDF creation tools and has to be monitored.
+            if image_obj["smask"] != 0 and not (image_obj["ext"] == 'png' or image_obj["ext"] == 'gif'):
+                continue
+
+            image_bytes = image_obj["image"]
+            image = self.image_masker.decode(image_bytes)
+            if image is None:
+                # The image format is not supported by OpenCV, like JBIG2 or CCITT, so PyMuPDF has to decode it.
+                image = self.decode_pixmap(pdf_document, xref)
+            if image is None:
+                logging.getLogger(__name__).warning(
+                    'Could not decode image %d on page %d, it is left unmasked.', xref, page_number + 1
+                )
+                continue
+            overlapping = self.is_overlapping_full_page(image, page_width, page_height)
+            pending_images.append((xref, image_bytes, image, overlapping))
+
+        # Only images overlapping the page need the detection model. All others are allowed to be fully masked.
+        detected_rects = iter(self.image_masker.find_rects_of_interest_batch(
+            [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for _, _, image, overlapping in pending_images if overlapping]
+        ))
+
+        replacements = []
+        for xref, image_bytes, image, overlapping in pending_images:
+            if overlapping:
+                areas_of_interest = next(detected_rects)
+            else:
+                areas_of_interest = self.image_masker.find_rects_of_interest(image, allow_full_mask=True)
+            result, amount_of_masks = self.image_masker.mask_data(
+                image_bytes,
+                allow_full_mask=not overlapping,
+                should_draw_gizmos=should_draw_gizmos,
+                areas_of_interest=areas_of_interest,
+                image=image
+            )
+            if amount_of_masks > 0:
+                # Only replace the image if any faces were detected. This keeps the original
+                # PDF content intact as much as possible.
+                replacements.append((xref, result))
+        return replacements
+
+    def mask_pages_in_pool(self, pdf_as_bytes: bytes, page_numbers: List[int],
+                           should_draw_gizmos: bool = False) -> Optional[List[List[Tuple[int, bytes]]]]:
+        """
+        Masks the given pages of the PDF data in parallel by the pool of worker processes.
+        If a worker process died, the pool is discarded and replaced by a new one on the next call.
+        :param pdf_as_bytes: The PDF data to mask.
+        :param page_numbers: The numbers of the pages to mask.
+        :param should_draw_gizmos: Whether to draw gizmos around the detected areas.
+        :return: The replacements for every given page, or None if the pool is broken and the pages have to be
+        masked in this process.
+        """
+        pool = self.get_page_pool()
+        try:
+            futures = [
+                pool.submit(_mask_page, pdf_as_bytes, page_number, should_draw_gizmos)
+                for page_number in page_numbers
+            ]
+            return [future.result() for future in futures]
+        except BrokenProcessPool:
+            logging.getLogger(__name__).warning('A page worker process died, masking the pages in this process.')
+            self.discard_page_pool(pool)
+            return None
+
+    def get_page_pool(self) -> ProcessPoolExecutor:
+        """
+        Returns the pool of worker processes for masking pages and starts it on first use.
+        The workers are spawned and load their own models, as the models can't be shared with forked processes.
+        :return: The pool of worker processes.
+        """
+        with self.page_pool_lock:
+            if self.page_pool is None:
+                self.page_pool = ProcessPoolExecutor(
+                    max_workers=self.page_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_page_worker,
+                    initargs=(self.page_worker_threads,)
+                )
+            return self.page_pool
+
+    def discard_page_pool(self, pool: ProcessPoolExecutor):
+        """
+        Discards a broken pool of worker processes, so the next call of get_page_pool starts a new one.
+        :param pool: The broken pool of worker processes.
+        """
+        with self.page_pool_lock:
+            if self.page_pool is pool:
+                self.page_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def decode_pixmap(self, pdf_document: fitz.Document, xref: int) -> Optional[MatLike]:
+        """
+        Decodes an image of the PDF with PyMuPDF into a BGR image.
+        PyMuPDF supports all image formats of PDFs, but it is slower than OpenCV and only used as a fallback.
+        :param pdf_document: The PDF document containing the image.
+        :param xref: The xref of the image.
+        :return: The decoded image, or None if the image can't be decoded.
+        """
+        try:
+            pixmap = fitz.Pixmap(pdf_document, xref)
+            if pixmap.alpha:
+                pixmap = fitz.Pixmap(pixmap, 0)
+            if pixmap.n != 3:
+                pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+        except Exception:
+            # PyMuPDF raises different exceptions for broken and unsupported images, depending on its version.
+            return None
+        image = np.frombuffer(pixmap.samples, np.uint8).reshape(pixmap.height, pixmap.width, 3)
+        return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+    def may_contain_faces(self, page: fitz.Page) -> bool:
+        """
+        Checks if any image of the page may contain a face, based on the dimensions of the images.
+        :param page: The page to check.
+        :return: True if any image of the page may contain a face, False otherwise.
+        """
+        return any(self.may_contain_face(img_info[2], img_info[3]) for img_info in page.get_images(full=True))
+
+    def may_contain_face(self, width: int, height: int) -> bool:
+        """
+        Checks if an image with the given dimensions is large enough and not too narrow to contain a face.
+        :param width: The width of the image.
+        :param height: The height of the image.
+        :return: True if the image may contain a face, False otherwise.
+        """
+        if width < self.min_image_size or height < self.min_image_size:
+            return False
+        return max(width, height) / min(width, height) <= self.max_image_aspect
+
+    def is_overlapping_full_page(self, image: MatLike, width: int, height: int) -> bool:
         """
         Checks if the image overlaps more than 80% of the page.
         :param image: The image to check.
@@ -75,5 +244,35 @@ class PDFMasker:
         :param height: The height of the page.
         :return: True if the image overlaps more than 80% of the page, False otherwise.
         """
-        image_width, image_height = image.size
+        image_height, image_width = image.shape[:2]
         return image_width > 0.8 * width and image_height > 0.8 * height
+
+
+# The PDFMasker of a page worker process. It is set up by the initializer of the process pool.
+_page_worker_masker = None
+
+
+def _init_page_worker(num_threads: int):
+    """
+    Initializes a page worker process with the PDFMasker of the app, which loads the models in this process.
+    :param num_threads: The number of threads the models and classifiers of the worker may use.
+    """
+    global _page_worker_masker
+    import app
+    app.init_services(num_threads)
+    _page_worker_masker = app.pdf_masker
+
+
+def _mask_page(pdf_as_bytes: bytes, page_number: int, should_draw_gizmos: bool) -> List[Tuple[int, bytes]]:
+    """
+    Masks a single page of the PDF data in a page worker process.
+    :param pdf_as_bytes: The PDF data containing the page.
+    :param page_number: The number of the page to mask.
+    :param should_draw_gizmos: Whether to draw gizmos around the detected areas.
+    :return: A list of tuples with the xref and the masked data of every image that has to be replaced.
+    """
+    pdf_document = fitz.open(stream=pdf_as_bytes, filetype="pdf")
+    try:
+        return _page_worker_masker.mask_page(pdf_document, page_number, should_draw_gizmos)
+    finally:
+        pdf_document.close()
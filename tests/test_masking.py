@@ -1,15 +1,22 @@
 import glob
 import io
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 
+import cv2
+import fitz  # PyMuPDF
 import imagehash
 import pytest
+import torch
 from PIL import Image
 from pdf2image import convert_from_bytes, convert_from_path
 
+import app as application
 from app import create_app
 
 url_prefix = '/api/v1/mask'
+images_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'images')
 
 
 @pytest.fixture()
@@ -60,6 +67,26 @@ def test_mask_pdf_wrong_file_type(client):
     }
 
 
+def test_mask_pdf_without_images(client):
+    """
+    Test the mask_pdf endpoint with a PDF that does not contain any images.
+
+    This test checks if the original PDF is returned unchanged when nothing has to be masked.
+
+    :param client: The test client used to send requests to the application.
+    """
+    pdf_document = fitz.open()
+    page = pdf_document.new_page()
+    page.insert_text((72, 72), "Resume without a picture")
+    pdf_as_bytes = pdf_document.tobytes()
+    pdf_document.close()
+
+    data = {'file': (io.BytesIO(pdf_as_bytes), 'test.pdf', 'application/pdf')}
+    response = client.post(url_prefix + '/pdf', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert response.data == pdf_as_bytes
+
+
 def test_mask_image_no_file(client):
     """
     Test the mask_image endpoint with no file in the request.
@@ -97,6 +124,24 @@ def test_mask_image_wrong_file_type(client):
     }
 
 
+def test_mask_image_without_faces(client):
+    """
+    Test the mask_image endpoint with an image that does not contain any faces.
+
+    This test checks if the original image is returned unchanged when nothing has to be masked.
+
+    :param client: The test client used to send requests to the application.
+    """
+    image_as_bytes = io.BytesIO()
+    Image.new('RGB', (200, 200), color=(200, 180, 160)).save(image_as_bytes, format='PNG')
+    image_as_bytes = image_as_bytes.getvalue()
+
+    data = {'file': (io.BytesIO(image_as_bytes), 'test.png', 'image/png')}
+    response = client.post(url_prefix + '/image', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert response.data == image_as_bytes
+
+
 def test_mask_image_with_examples(client):
     """
     Test the mask_image endpoint with all jpg image files in the data directory.
@@ -134,6 +179,156 @@ def test_mask_image_with_examples(client):
         assert similarity > 0.95
 
 
+def test_find_rects_of_interest_batch_with_mixed_sizes(app):
+    """
+    Test finding rectangles of interest for a batch of images with different sizes.
+
+    This test checks if the rectangles found for each image in a padded batch match the rectangles
+    found for the same image on its own. The smaller image is padded in the batch, which may shift
+    the boxes slightly, but must not stretch them.
+
+    :param app: The Flask application instance.
+    """
+    large_image = cv2.imread(os.path.join(images_dir, 'test_mask_image_upper_body.jpg'))
+    small_image = cv2.imread(os.path.join(images_dir, 'test_mask_image_simple.jpg'))
+    small_image = cv2.resize(small_image, (small_image.shape[1] // 2, small_image.shape[0] // 2))
+    images = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in (large_image, small_image)]
+
+    batch_rects = application.image_masker.find_rects_of_interest_batch(images)
+    single_rects = [application.image_masker.find_rects_of_interest(image) for image in images]
+
+    for image, rects_in_batch, rects_alone in zip(images, batch_rects, single_rects):
+        assert len(rects_in_batch) == len(rects_alone)
+        tolerance = 0.05 * max(image.shape[:2])
+        for rect_in_batch, rect_alone in zip(sorted(rects_in_batch), sorted(rects_alone)):
+            assert all(abs(a - b) <= tolerance for a, b in zip(rect_in_batch, rect_alone))
+
+
+def test_preprocess_matches_image_processor(app):
+    """
+    Test the preprocessing of images for the detection model.
+
+    This test checks if the pixel values of the torchvision preprocessing are close to the pixel values
+    of the YOLOS image processor it replaces. The resized sizes may differ by a pixel due to rounding.
+
+    :param app: The Flask application instance.
+    """
+    image = cv2.cvtColor(cv2.imread(os.path.join(images_dir, 'test_mask_image_simple.jpg')), cv2.COLOR_BGR2RGB)
+
+    expected = application.image_processor(
+        images=image,
+        return_tensors="pt",
+        input_data_format="channels_last"
+    )["pixel_values"][0]
+    actual = application.image_masker.preprocess(image)
+
+    assert actual.shape[0] == expected.shape[0]
+    assert abs(actual.shape[1] - expected.shape[1]) <= 1
+    assert abs(actual.shape[2] - expected.shape[2]) <= 1
+    height = min(actual.shape[1], expected.shape[1])
+    width = min(actual.shape[2], expected.shape[2])
+    difference = torch.abs(actual[:, :height, :width] - expected[:, :height, :width])
+    assert difference.mean() < 0.1
+
+
+def test_decode_pixmap(app):
+    """
+    Test the decoding of PDF images with PyMuPDF, which is the fallback for images OpenCV can't decode.
+
+    This test checks if the decoded image is close to the image decoded by OpenCV.
+
+    :param app: The Flask application instance.
+    """
+    image_path = os.path.join(images_dir, 'test_mask_image_simple.jpg')
+    expected = cv2.imread(image_path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    pdf_document = fitz.open()
+    page = pdf_document.new_page()
+    page.insert_image(page.rect, filename=image_path)
+    xref = page.get_images()[0][0]
+
+    actual = application.pdf_masker.decode_pixmap(pdf_document, xref)
+    pdf_document.close()
+
+    assert actual.shape == expected.shape
+    assert cv2.absdiff(actual, expected).mean() < 2
+
+
+def test_mask_pdf_with_broken_page_pool(app):
+    """
+    Test the masking of PDFs with multiple pages when the pool of worker processes is broken.
+
+    This test checks if the pages are masked in the process of the app if a worker process died,
+    and if the broken pool is discarded, so it is replaced on the next request.
+
+    :param app: The Flask application instance.
+    """
+    pdf_document = fitz.open()
+    for _ in range(2):
+        page = pdf_document.new_page()
+        page.insert_image(page.rect, filename=os.path.join(images_dir, 'test_mask_image_simple.jpg'))
+    pdf_as_bytes = pdf_document.tobytes()
+    pdf_document.close()
+
+    pdf_masker = application.pdf_masker
+    page_workers = pdf_masker.page_workers
+    page_pool = pdf_masker.page_pool
+    try:
+        pdf_masker.page_workers = 1
+        expected = pdf_masker.mask_data(pdf_as_bytes)
+
+        # The worker processes of this pool exit immediately, which breaks the pool on the first page.
+        pdf_masker.page_pool = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=os._exit,
+            initargs=(1,)
+        )
+        pdf_masker.page_workers = 2
+        actual = pdf_masker.mask_data(pdf_as_bytes)
+        assert pdf_masker.page_pool is None
+    finally:
+        pdf_masker.page_workers = page_workers
+        pdf_masker.page_pool = page_pool
+
+    assert render_pdf(actual) == render_pdf(expected)
+
+
+def test_mask_pdf_with_single_image_page(app):
+    """
+    Test the masking of PDFs with multiple pages, of which only one has images.
+
+    This test checks if such PDFs are masked in the process of the app, without using the pool of worker processes.
+
+    :param app: The Flask application instance.
+    """
+    pdf_document = fitz.open()
+    page = pdf_document.new_page()
+    page.insert_image(page.rect, filename=os.path.join(images_dir, 'test_mask_image_simple.jpg'))
+    pdf_document.new_page()
+    pdf_as_bytes = pdf_document.tobytes()
+    pdf_document.close()
+
+    pdf_masker = application.pdf_masker
+    page_workers = pdf_masker.page_workers
+    page_pool = pdf_masker.page_pool
+    # The worker processes of this pool exit immediately, so using it would discard it.
+    unused_pool = ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=os._exit,
+        initargs=(1,)
+    )
+    pdf_masker.page_pool = unused_pool
+    pdf_masker.page_workers = 2
+    try:
+        pdf_masker.mask_data(pdf_as_bytes)
+        assert pdf_masker.page_pool is unused_pool
+    finally:
+        pdf_masker.page_workers = page_workers
+        pdf_masker.page_pool = page_pool
+        unused_pool.shutdown()
+
+
 def test_mask_pdf_from_different_tools(client):
     """
     Test the mask_pdf endpoint with all pdf files in the data directory.
@@ -242,3 +437,11 @@ def compare_pdfs(pdf1_content, pdf2_path):
         similarity_scores.append(similarity_score)
 
     return similarity_scores
+
+
+def render_pdf(pdf_content):
+    # Render all pages of the PDF to raw pixel data
+    pdf_document = fitz.open(stream=pdf_content, filetype="pdf")
+    pages = [page.get_pixmap().samples for page in pdf_document]
+    pdf_document.close()
+    return pages